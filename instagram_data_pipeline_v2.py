@@ -1,21 +1,49 @@
 import os
+import base64
+import hashlib
 import logging
 import re
+import queue
+import random
+import threading
 import emoji
-from typing import List, Dict, Any
+import numpy as np
+import orjson
+from typing import List, Dict, Any, Tuple, Optional, Callable, Iterator
 from dotenv import load_dotenv
 from supabase import create_client, Client
 from datetime import datetime, timezone
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from openai import OpenAI
 from pinecone import Pinecone, ServerlessSpec
+from pinecone.exceptions import NotFoundException
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util import Retry
 import time
-from dateutil import parser
 
 # Set up basic logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
+load_dotenv()
+
+# Reused across warm Cloud Function invocations so clients and connection pools persist
+_PIPELINE = None
+
+# Compiled once at import; clean_text runs for every post, comment and reply
+_URL_RE = re.compile(r'http\S+|www\.\S+')
+_NON_ALPHA_RE = re.compile(r'[^a-zA-Z_:\s]')
+_COLON_TABLE = str.maketrans('', '', ':')
+
+# Marks the end of a paginated response on the prefetch queue
+_END_OF_PAGES = object()
+
+def _parse_ts(timestamp: str) -> datetime:
+    # Instagram returns strict ISO-8601 timestamps such as 2024-01-01T12:34:56+0000
+    return datetime.strptime(timestamp, '%Y-%m-%dT%H:%M:%S%z')
+
 class InstagramDataPipelineV2:
     def __init__(self):
         self.supabase = self.init_supabase()
@@ -26,8 +54,23 @@ class InstagramDataPipelineV2:
         if not self.instagram_access_token:
             raise ValueError("INSTAGRAM_ACCESS_TOKEN not found in environment variables")
         self.base_url = "https://graph.instagram.com/v17.0"
-        self.rate_limit_delay = 1  # 1 second delay between requests
+        self.rate_limit_delay = 1  # Base delay in seconds for retry backoff
+        self.usage_threshold = 75  # Percent of Graph API quota used before requests slow down
+        self.max_throttle_delay = 10  # Delay in seconds per request once the quota is exhausted
         self.max_retries = 3
+        self.session = self.init_session()
+        self.embedding_model = "text-embedding-3-small"
+        self.embedding_batch_size = 256  # Inputs per OpenAI embeddings request
+        self.embedding_cache_size = 10000  # Embeddings kept in memory between runs
+        self.embedding_cache_lookup_size = 100  # Keys per embedding_cache query
+        self.embedding_cache_write_size = 50  # Rows per embedding_cache upsert; each row holds a full vector
+        self._embedding_cache = OrderedDict()
+        self.pinecone_batch_size = 100  # Vectors per Pinecone upsert request
+        self.supabase_batch_size = 500  # Rows per Supabase upsert request
+        self.max_workers = 8  # Cap on concurrent Instagram API requests
+        self.request_jitter = 0.1  # Max random delay before a queued request, in seconds
+        self._executor = ThreadPoolExecutor(max_workers=self.max_workers)
+        self._request_semaphore = threading.Semaphore(self.max_workers)
 
     def init_supabase(self) -> Client:
         supabase_url = os.getenv('SUPABASE_URL')
@@ -49,14 +92,17 @@ class InstagramDataPipelineV2:
         pc = Pinecone(api_key=pinecone_api_key)
         
         index_name = "instagram-data"
-        if index_name not in pc.list_indexes().names():
+        # Opening the index already looks it up, so only create it when that lookup fails
+        try:
+            return pc.Index(index_name, pool_threads=16)
+        except NotFoundException:
             pc.create_index(
                 name=index_name,
                 dimension=1536,
                 metric="cosine",
                 spec=ServerlessSpec(cloud="aws", region="us-east-1")
             )
-        return pc.Index(index_name)
+            return pc.Index(index_name, pool_threads=16)
 
     def load_last_fetch_time(self) -> datetime:
         result = self.supabase.table('metadata').select('value').eq('key', 'last_fetch_time').execute()
@@ -67,60 +113,172 @@ class InstagramDataPipelineV2:
     def save_last_fetch_time(self):
         self.supabase.table('metadata').upsert({'key': 'last_fetch_time', 'value': datetime.now(timezone.utc).isoformat()}).execute()
 
-    def _make_paginated_request(self, url: str, params: Dict[str, Any]) -> List[Dict[str, Any]]:
+    def init_session(self) -> requests.Session:
+        retry = Retry(
+            total=self.max_retries,
+            backoff_factor=self.rate_limit_delay,
+            status_forcelist=[429, 500, 502, 503, 504],
+            respect_retry_after_header=True
+        )
+        adapter = HTTPAdapter(pool_connections=16, pool_maxsize=32, max_retries=retry)
+        session = requests.Session()
+        session.mount("https://", adapter)
+        return session
+
+    def _make_paginated_request(self, url: str, params: Dict[str, Any],
+                                stop_predicate: Optional[Callable[[List[Dict[str, Any]]], bool]] = None) -> List[Dict[str, Any]]:
         all_data = []
-        retry_count = 0
 
-        while url and retry_count < self.max_retries:
-            try:
-                logger.debug(f"Making request to URL: {url}")
-                response = requests.get(url, params=params)
-                response.raise_for_status()
-                data = response.json()
-                
-                logger.debug(f"Received data: {data}")
-                all_data.extend(data.get('data', []))
-                
-                paging = data.get('paging', {})
-                url = paging.get('next')  # Get the next URL for pagination
-                
-                if url:
-                    params = {}  # Clear params for subsequent requests
-                    time.sleep(self.rate_limit_delay)  # Respect rate limits
-                
-                retry_count = 0  # Reset retry count on successful request
-            except requests.RequestException as e:
-                retry_count += 1
-                logger.warning(f"Request failed: {e}. Retrying ({retry_count}/{self.max_retries})...")
-                time.sleep(self.rate_limit_delay * 2 ** retry_count)  # Exponential backoff
-
-        if retry_count == self.max_retries:
-            logger.error("Max retries reached. Some data may be missing.")
+        try:
+            while url:
+                page, url = self._fetch_page(url, params)
+                all_data.extend(page)
+
+                if stop_predicate and page and stop_predicate(page):
+                    logger.debug("Stop condition met, skipping remaining pages")
+                    break
+                params = {}  # Clear params for subsequent requests
+        except (requests.RequestException, orjson.JSONDecodeError) as e:
+            logger.error(f"Request failed after retries: {e}. Some data may be missing.")
 
         logger.debug(f"Total data fetched: {len(all_data)}")
         return all_data
 
-    def fetch_posts(self, limit: int = 100) -> List[Dict[str, Any]]:
+    def _iter_paginated_request(self, url: str, params: Dict[str, Any],
+                                stop_predicate: Optional[Callable[[List[Dict[str, Any]]], bool]] = None) -> Iterator[List[Dict[str, Any]]]:
+        # A worker thread fetches the next page while the caller processes the current one
+        pages = queue.Queue(maxsize=2)
+        stop = threading.Event()
+        worker = threading.Thread(target=self._prefetch_pages, args=(url, params, pages, stop, stop_predicate), daemon=True)
+        worker.start()
+
+        try:
+            while True:
+                page = pages.get()
+                if page is _END_OF_PAGES:
+                    break
+                if isinstance(page, Exception):
+                    raise page
+                yield page
+
+                if stop_predicate and page and stop_predicate(page):
+                    logger.debug("Stop condition met, skipping remaining pages")
+                    break
+        finally:
+            stop.set()
+
+    def _prefetch_pages(self, url: str, params: Dict[str, Any], pages: queue.Queue, stop: threading.Event,
+                        stop_predicate: Optional[Callable[[List[Dict[str, Any]]], bool]] = None):
+        try:
+            while url and not stop.is_set():  # Checked before every request, including after a throttle wait
+                page, url = self._fetch_page(url, params, stop)
+                self._put_page(pages, page, stop)
+
+                # Check here too, so the worker doesn't request pages the consumer will discard
+                if stop_predicate and page and stop_predicate(page):
+                    break
+                params = {}  # Clear params for subsequent requests
+        except (requests.RequestException, orjson.JSONDecodeError) as e:
+            logger.error(f"Request failed after retries: {e}. Some data may be missing.")
+        except Exception as e:
+            self._put_page(pages, e, stop)
+        finally:
+            self._put_page(pages, _END_OF_PAGES, stop)
+
+    def _fetch_page(self, url: str, params: Dict[str, Any],
+                    stop: Optional[threading.Event] = None) -> Tuple[List[Dict[str, Any]], Optional[str]]:
+        logger.debug(f"Making request to URL: {url}")
+        with self._request_semaphore:
+            response = self.session.get(url, params=params)
+        response.raise_for_status()
+        self._throttle(response, stop)
+        data = orjson.loads(response.content)
+
+        logger.debug(f"Received data: {data}")
+        return data.get('data', []), data.get('paging', {}).get('next')  # Next URL for pagination
+
+    def _put_page(self, pages: queue.Queue, item: Any, stop: threading.Event):
+        # Give up once the consumer has stopped reading so the worker thread can exit
+        while not stop.is_set():
+            try:
+                pages.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    def _throttle(self, response: requests.Response, stop: Optional[threading.Event] = None):
+        # Only slow down when Graph API usage headers report we are close to the quota;
+        # 429s are retried with Retry-After by the session's adapter
+        usage = 0
+        try:
+            app_usage = orjson.loads(response.headers.get('X-App-Usage', '{}'))
+            usage = max(app_usage.values(), default=0)
+            business_usage = orjson.loads(response.headers.get('X-Business-Use-Case-Usage', '{}'))
+            for entries in business_usage.values():
+                for entry in entries:
+                    usage = max(usage, entry.get('call_count', 0), entry.get('total_time', 0), entry.get('total_cputime', 0))
+        except (orjson.JSONDecodeError, AttributeError, TypeError):
+            logger.debug("Could not parse Graph API usage headers")
+
+        if usage > self.usage_threshold:
+            delay = self.max_throttle_delay * min(usage - self.usage_threshold, 100 - self.usage_threshold) / (100 - self.usage_threshold)
+            logger.info(f"Graph API usage at {usage}%, waiting {delay:.1f}s")
+            if stop is not None:
+                stop.wait(delay)  # Wake early if the prefetch consumer has stopped
+            else:
+                time.sleep(delay)
+
+    def _jittered(self, func, *args):
+        # Spread out queued requests to avoid bursts that trigger 429s
+        time.sleep(random.uniform(0, self.request_jitter))
+        return func(*args)
+
+    def _iter_media_pages(self, limit: int) -> Iterator[List[Dict[str, Any]]]:
         url = f"{self.base_url}/me/media"
         params = {
             "fields": "id,caption,media_type,media_url,permalink,timestamp,like_count,comments_count",
             "access_token": self.instagram_access_token,
             "limit": limit
         }
-        posts = self._make_paginated_request(url, params)
-        new_posts = [
-            post for post in posts 
-            if parser.parse(post['timestamp']).replace(tzinfo=timezone.utc) > self.last_fetch_time
-        ]
-        return new_posts
+        # Media is returned newest first, so stop once a page reaches already-fetched posts
+        return self._iter_paginated_request(
+            url, params,
+            stop_predicate=lambda page: _parse_ts(page[-1]['timestamp']) <= self.last_fetch_time
+        )
+
+    def iter_post_pages(self, limit: int = 100) -> Iterator[List[Dict[str, Any]]]:
+        skipped = 0
+        for page in self._iter_media_pages(limit):
+            new_posts = [
+                post for post in page
+                if _parse_ts(post['timestamp']) > self.last_fetch_time
+            ]
+            skipped += len(page) - len(new_posts)
+            yield new_posts
+
+        if skipped:
+            # Older posts aren't revisited, so their new comments and replies are missed
+            logger.info(f"Skipped {skipped} posts older than {self.last_fetch_time.isoformat()}; "
+                        f"reset last_fetch_time to backfill their new comments")
+
+    def fetch_posts(self, limit: int = 100) -> List[Dict[str, Any]]:
+        return [post for page in self.iter_post_pages(limit) for post in page]
 
     def fetch_comments(self, post_id: str) -> List[Dict[str, Any]]:
         url = f"{self.base_url}/{post_id}/comments"
         params = {
-            "fields": "id,text,timestamp,username,replies",
+            # Expand replies inline so they don't need a request each
+            "fields": "id,text,timestamp,username,replies.limit(50){id,text,timestamp,username}",
             "access_token": self.instagram_access_token
         }
-        return self._make_paginated_request(url, params)
+        comments = self._make_paginated_request(url, params)
+        for comment in comments:
+            replies = comment.get('replies', {})
+            next_url = replies.get('paging', {}).get('next')
+            if next_url:
+                # Comment has more replies than fit in the expanded field
+                replies['data'] = replies.get('data', []) + self._make_paginated_request(next_url, {})
+        return comments
 
     def fetch_replies(self, comment_id: str) -> List[Dict[str, Any]]:
         url = f"{self.base_url}/{comment_id}/replies"
@@ -133,7 +291,7 @@ class InstagramDataPipelineV2:
         logger.debug(f"Fetched {len(replies)} total replies for comment {comment_id}")
         new_replies = [
             reply for reply in replies
-            if parser.parse(reply['timestamp']).replace(tzinfo=timezone.utc) > self.last_fetch_time
+            if _parse_ts(reply['timestamp']) > self.last_fetch_time
         ]
         logger.debug(f"Found {len(new_replies)} new replies for comment {comment_id}")
         return new_replies
@@ -141,65 +299,155 @@ class InstagramDataPipelineV2:
     def clean_text(self, text: str) -> str:
         if text is None:
             return ""
-        text = emoji.demojize(text, language='en')
-        text = text.lower()
-        text = re.sub(r'http\S+|www.\S+', '', text)
-        text = re.sub(r'[^a-zA-Z_:\s]', '', text)
-        text = re.sub(r':', '', text)  # Remove colons from emoji names
+        if not text.isascii():  # Every emoji contains non-ASCII code points
+            text = emoji.demojize(text, language='en')
+        text = _URL_RE.sub('', text.lower())
+        text = _NON_ALPHA_RE.sub('', text)
+        text = text.translate(_COLON_TABLE)  # Remove colons from emoji names
         return ' '.join(text.split())
 
-    def generate_embedding(self, text: str) -> List[float]:
-        response = self.openai_client.embeddings.create(input=text, model="text-embedding-3-small")
-        return response.data[0].embedding
+    def generate_embedding(self, text: str) -> np.ndarray:
+        return self.generate_embeddings([text])[0]
+
+    def generate_embeddings(self, texts: List[str]) -> np.ndarray:
+        # base64 responses decode straight into a float32 array, skipping per-value Python floats
+        response = self.openai_client.embeddings.create(
+            input=texts, model=self.embedding_model, encoding_format="base64"
+        )
+        raw = b''.join(base64.b64decode(d.embedding) for d in response.data)
+        return np.frombuffer(raw, dtype=np.float32).reshape(len(response.data), -1)
+
+    def embed_texts(self, texts: List[str]) -> Iterator[Dict[str, np.ndarray]]:
+        keys = {text: self.embedding_cache_key(text) for text in texts}
+        cached = self.load_cached_embeddings(list(keys.values()))
+        hits = {text: cached[key] for text, key in keys.items() if key in cached}
+        if hits:
+            logger.info(f"Reusing {len(hits)} cached embeddings")
+            yield hits
+
+        misses = [text for text in texts if text not in hits]
+        batches = [
+            misses[start:start + self.embedding_batch_size]
+            for start in range(0, len(misses), self.embedding_batch_size)
+        ]
+        new_embeddings = {}
+        # Batches are independent, so overlap their round-trips on the executor
+        for batch_embeddings in self._executor.map(self._embed_batch, batches):
+            new_embeddings.update((keys[text], embedding) for text, embedding in batch_embeddings.items())
+            yield batch_embeddings
+
+        self.save_cached_embeddings(new_embeddings)
+
+    def embedding_cache_key(self, text: str) -> str:
+        return hashlib.sha256(f"{self.embedding_model}:{text}".encode()).hexdigest()
+
+    def load_cached_embeddings(self, keys: List[str]) -> Dict[str, np.ndarray]:
+        cached = {}
+        for key in keys:
+            if key in self._embedding_cache:
+                self._embedding_cache.move_to_end(key)
+                cached[key] = self._embedding_cache[key]
+
+        remote_keys = [key for key in keys if key not in cached]
+        try:
+            for start in range(0, len(remote_keys), self.embedding_cache_lookup_size):
+                batch = remote_keys[start:start + self.embedding_cache_lookup_size]
+                result = self.supabase.table('embedding_cache').select('id,embedding').in_('id', batch).execute()
+                for row in result.data:
+                    cached[row['id']] = np.asarray(row['embedding'], dtype=np.float32)
+        except Exception as e:
+            logger.warning(f"Could not read embedding cache: {str(e)}")
+
+        self._remember_embeddings(cached)
+        return cached
+
+    def save_cached_embeddings(self, embeddings: Dict[str, np.ndarray]):
+        self._remember_embeddings(embeddings)
+        rows = [{'id': key, 'embedding': embedding.tolist()} for key, embedding in embeddings.items()]
+        try:
+            self.upsert_rows('embedding_cache', rows, batch_size=self.embedding_cache_write_size)
+        except Exception as e:
+            logger.warning(f"Could not write embedding cache: {str(e)}")
+
+    def _remember_embeddings(self, embeddings: Dict[str, np.ndarray]):
+        self._embedding_cache.update(embeddings)
+        while len(self._embedding_cache) > self.embedding_cache_size:
+            self._embedding_cache.popitem(last=False)  # Evict least recently used
+
+    def _embed_batch(self, batch: List[str]) -> Dict[str, np.ndarray]:
+        try:
+            return dict(zip(batch, self.generate_embeddings(batch)))
+        except Exception as e:
+            logger.warning(f"Batch embedding failed: {e}. Falling back to single-text requests...")
+            embeddings = {}
+            for text in batch:
+                try:
+                    embeddings[text] = self.generate_embedding(text)
+                except Exception as e:
+                    logger.error(f"Error generating embedding for text '{text}': {str(e)}")
+            return embeddings
+
+    def embed_pending(self, pending: List[Tuple[str, Dict[str, Any]]]) -> Iterator[Dict[str, Any]]:
+        # Embed each distinct text once and share the vector between items with the same text
+        items_by_text = {}
+        skipped = 0
+        for item_id, metadata in pending:
+            if not metadata['text']:  # OpenAI rejects empty input, which would fail the whole batch
+                skipped += 1
+                continue
+            items_by_text.setdefault(metadata['text'], []).append((item_id, metadata))
+        if skipped:
+            logger.info(f"Skipping {skipped} items with no text to embed")
+        logger.info(f"Embedding {len(items_by_text)} unique texts for {len(pending)} items")
+
+        # Yield vectors as each batch completes so uploads can start before all batches finish
+        for batch_embeddings in self.embed_texts(list(items_by_text)):
+            for text, embedding in batch_embeddings.items():
+                for item_id, metadata in items_by_text[text]:
+                    yield {'id': item_id, 'values': embedding, 'metadata': metadata}
 
     def process_and_upload_data(self):
-        all_posts = self.fetch_all_posts()
-        logger.info(f"Fetched {len(all_posts)} posts")
+        new_posts = []
+        comment_futures = {}
 
-        vectors = []
+        # Fetch comments for each page of new posts concurrently while the next page is prefetched
+        for page in self.iter_post_pages(limit=100):
+            for post in page:
+                comment_futures[post['id']] = self._executor.submit(self._jittered, self.fetch_comments, post['id'])
+            new_posts.extend(page)
+        logger.info(f"Fetched {len(new_posts)} new posts")
 
-        for post in all_posts:
+        pending = []
+        post_rows, comment_rows = [], []
+
+        for post in new_posts:
             try:
-                post_timestamp = parser.parse(post['timestamp']).replace(tzinfo=timezone.utc)
-                
-                if post_timestamp > self.last_fetch_time:
-                    # Process new post
-                    clean_caption = self.clean_text(post.get('caption'))
-                    vector = {
-                        'id': post['id'],
-                        'values': self.generate_embedding(clean_caption),
-                        'metadata': {
-                            'type': 'post',
-                            'timestamp': post['timestamp'],
-                            'likes': post.get('like_count', 0),
-                            'comments': post.get('comments_count', 0),
-                            'text': clean_caption
-                        }
-                    }
-                    vectors.append(vector)
-                    self.supabase.table('posts').upsert(post, on_conflict='id').execute()
+                clean_caption = self.clean_text(post.get('caption'))
+                pending.append((post['id'], {
+                    'type': 'post',
+                    'timestamp': post['timestamp'],
+                    'likes': post.get('like_count', 0),
+                    'comments': post.get('comments_count', 0),
+                    'text': clean_caption
+                }))
+                post_rows.append(post)
 
-                comments = self.fetch_comments(post['id'])
+                comments = comment_futures[post['id']].result()
                 logger.info(f"Fetched {len(comments)} comments for post {post['id']}")
 
                 for comment in comments:
-                    comment_timestamp = parser.parse(comment['timestamp']).replace(tzinfo=timezone.utc)
+                    comment_timestamp = _parse_ts(comment['timestamp'])
                     
                     if comment_timestamp > self.last_fetch_time:
                         # Process new comment
                         clean_text = self.clean_text(comment.get('text'))
-                        vector = {
-                            'id': comment['id'],
-                            'values': self.generate_embedding(clean_text),
-                            'metadata': {
-                                'type': 'comment',
-                                'timestamp': comment['timestamp'],
-                                'post_id': post['id'],
-                                'username': comment.get('username', 'unknown_user'),
-                                'text': clean_text
-                            }
-                        }
-                        vectors.append(vector)
+                        pending.append((comment['id'], {
+                            'type': 'comment',
+                            'timestamp': comment['timestamp'],
+                            'post_id': post['id'],
+                            'username': comment.get('username', 'unknown_user'),
+                            'text': clean_text
+                        }))
                         comment_data = {
                             'id': comment['id'],
                             'post_id': post['id'],
@@ -208,73 +456,83 @@ class InstagramDataPipelineV2:
                             'username': comment.get('username', 'unknown_user'),
                             'replied': False
                         }
-                        self.supabase.table('comments').upsert(comment_data, on_conflict='id').execute()
-
-                    # Process replies
-                    if 'replies' in comment and 'data' in comment['replies']:
-                        for reply_data in comment['replies']['data']:
-                            full_reply = self.fetch_reply(reply_data['id'])
-                            if full_reply:
-                                reply_timestamp = parser.parse(full_reply['timestamp']).replace(tzinfo=timezone.utc)
-                                
-                                if reply_timestamp > self.last_fetch_time:
-                                    # Process new reply
-                                    clean_reply_text = self.clean_text(full_reply.get('text'))
-                                    reply_vector = {
-                                        'id': full_reply['id'],
-                                        'values': self.generate_embedding(clean_reply_text),
-                                        'metadata': {
-                                            'type': 'reply',
-                                            'timestamp': full_reply['timestamp'],
-                                            'post_id': post['id'],
-                                            'parent_comment_id': comment['id'],
-                                            'username': full_reply.get('username', 'unknown_user'),
-                                            'text': clean_reply_text
-                                        }
-                                    }
-                                    vectors.append(reply_vector)
-                                    reply_data = {
-                                        'id': full_reply['id'],
-                                        'post_id': post['id'],
-                                        'parent_comment_id': comment['id'],
-                                        'text': full_reply.get('text'),
-                                        'timestamp': full_reply['timestamp'],
-                                        'username': full_reply.get('username', 'unknown_user'),
-                                        'replied': False
-                                    }
-                                    self.supabase.table('comments').upsert(reply_data, on_conflict='id').execute()
-
-                time.sleep(self.rate_limit_delay)
+                        comment_rows.append(comment_data)
+
+                    # Process replies, already expanded inline by fetch_comments
+                    for reply in comment.get('replies', {}).get('data', []):
+                        reply_timestamp = _parse_ts(reply['timestamp'])
+
+                        if reply_timestamp > self.last_fetch_time:
+                            # Process new reply
+                            clean_reply_text = self.clean_text(reply.get('text'))
+                            pending.append((reply['id'], {
+                                'type': 'reply',
+                                'timestamp': reply['timestamp'],
+                                'post_id': post['id'],
+                                'parent_comment_id': comment['id'],
+                                'username': reply.get('username', 'unknown_user'),
+                                'text': clean_reply_text
+                            }))
+                            reply_data = {
+                                'id': reply['id'],
+                                'post_id': post['id'],
+                                'parent_comment_id': comment['id'],
+                                'text': reply.get('text'),
+                                'timestamp': reply['timestamp'],
+                                'username': reply.get('username', 'unknown_user'),
+                                'replied': False
+                            }
+                            comment_rows.append(reply_data)
+
             except Exception as e:
                 logger.error(f"Error processing post {post['id']}: {str(e)}")
 
-        if vectors:
-            logger.info(f"Uploading {len(vectors)} vectors to Pinecone")
-            self.pinecone_index.upsert(vectors=vectors)
+        # Write rows to Supabase in the background while embeddings are generated
+        rows_future = self._executor.submit(self.save_rows, post_rows, comment_rows)
+
+        logger.info(f"Generating embeddings for {len(pending)} items")
+        vector_buffer = []
+        upload_futures = []
+        vector_count = 0
+        for vector in self.embed_pending(pending):
+            vector_buffer.append(vector)
+            vector_count += 1
+            if len(vector_buffer) >= self.pinecone_batch_size:
+                upload_futures.append(self._executor.submit(self.upload_vectors, vector_buffer))
+                vector_buffer = []
+        if vector_buffer:
+            upload_futures.append(self._executor.submit(self.upload_vectors, vector_buffer))
+
+        if vector_count:
+            for future in upload_futures:
+                future.result()
+            logger.info(f"Uploaded {vector_count} vectors to Pinecone in {len(upload_futures)} batches")
         else:
             logger.info("No new data to process and upload")
 
-    def fetch_all_posts(self) -> List[Dict[str, Any]]:
-        url = f"{self.base_url}/me/media"
-        params = {
-            "fields": "id,caption,media_type,media_url,permalink,timestamp,like_count,comments_count",
-            "access_token": self.instagram_access_token,
-            "limit": 100  # Maximum allowed by Instagram API
-        }
-        return self._make_paginated_request(url, params)
+        missing = sum(1 for _, metadata in pending if metadata['text']) - vector_count  # Empty texts are skipped on purpose
+        if missing:
+            logger.error(f"Skipped {missing} items without embeddings")
 
-    def fetch_reply(self, reply_id: str) -> Dict[str, Any]:
-        url = f"{self.base_url}/{reply_id}"
-        params = {
-            "fields": "id,text,timestamp,username",
-            "access_token": self.instagram_access_token
-        }
-        response = requests.get(url, params=params)
-        if response.status_code == 200:
-            return response.json()
-        else:
-            logger.error(f"Failed to fetch reply {reply_id}: {response.status_code}")
-            return None
+        rows_future.result()
+
+    def upload_vectors(self, vectors: List[Dict[str, Any]]):
+        # Pinecone expects plain lists, so convert from float32 arrays only at upload time
+        self.pinecone_index.upsert(vectors=[{**vector, 'values': vector['values'].tolist()} for vector in vectors])
+
+    def save_rows(self, post_rows: List[Dict[str, Any]], comment_rows: List[Dict[str, Any]]):
+        # Posts go first so comment rows can reference them
+        self.upsert_rows('posts', post_rows)
+        self.upsert_rows('comments', comment_rows)
+
+    def upsert_rows(self, table: str, rows: List[Dict[str, Any]], batch_size: Optional[int] = None):
+        batch_size = batch_size or self.supabase_batch_size
+        for start in range(0, len(rows), batch_size):
+            batch = rows[start:start + batch_size]
+            self.supabase.table(table).upsert(batch, on_conflict='id').execute()
+
+    def fetch_all_posts(self) -> List[Dict[str, Any]]:
+        return [post for page in self._iter_media_pages(limit=100) for post in page]
 
     def run(self):
         try:
@@ -286,10 +544,14 @@ class InstagramDataPipelineV2:
             raise
 
 def main(event, context):
+    global _PIPELINE
     try:
-        load_dotenv()
-        pipeline = InstagramDataPipelineV2()
-        pipeline.run()
+        if _PIPELINE is None:
+            _PIPELINE = InstagramDataPipelineV2()
+        else:
+            # Warm instance: pick up the fetch time saved by the previous invocation
+            _PIPELINE.last_fetch_time = _PIPELINE.load_last_fetch_time()
+        _PIPELINE.run()
         return "Data pipeline completed successfully", 200
     except Exception as e:
         logger.error(f"Error in data pipeline: {str(e)}")
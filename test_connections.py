@@ -4,6 +4,10 @@ from dotenv import load_dotenv
 from supabase import create_client, Client
 from pinecone import Pinecone
 import logging
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from logging.handlers import QueueHandler
 
 # Set up logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -17,6 +21,7 @@ def test_instagram_connection():
     
     base_url = "https://graph.instagram.com/v17.0"
     
+    session = requests.Session()  # Reuse one keep-alive connection for both requests
     try:
         url = f"{base_url}/me"
         params = {
@@ -24,7 +29,7 @@ def test_instagram_connection():
             "access_token": instagram_access_token
         }
         
-        response = requests.get(url, params=params)
+        response = session.get(url, params=params)
         response.raise_for_status()
         
         user_data = response.json()
@@ -39,7 +44,7 @@ def test_instagram_connection():
             "access_token": instagram_access_token
         }
         
-        media_response = requests.get(media_url, params=media_params)
+        media_response = session.get(media_url, params=media_params)
         media_response.raise_for_status()
         
         media_data = media_response.json()
@@ -52,6 +57,8 @@ def test_instagram_connection():
         logger.info("Instagram connection test completed successfully")
     except Exception as e:
         logger.error(f"Error testing Instagram connection: {str(e)}")
+    finally:
+        session.close()
 
 def test_supabase_connection():
     logger.info("Testing Supabase connection...")
@@ -115,14 +122,40 @@ def test_pinecone_connection():
     except Exception as e:
         logger.error(f"Error testing Pinecone connection: {str(e)}")
 
+def run_checks_concurrently(checks):
+    # Buffer each check's log records so its output is printed as one block
+    buffers = [queue.Queue() for _ in checks]
+
+    def run_check(check, buffer):
+        handler = QueueHandler(buffer)
+        thread_id = threading.get_ident()
+        handler.addFilter(lambda record: record.thread == thread_id)
+        logger.addHandler(handler)
+        try:
+            check()
+        finally:
+            logger.removeHandler(handler)
+
+    logger.propagate = False
+    try:
+        with ThreadPoolExecutor(max_workers=len(checks)) as executor:
+            futures = [executor.submit(run_check, check, buffer) for check, buffer in zip(checks, buffers)]
+    finally:
+        logger.propagate = True
+
+    for i, buffer in enumerate(buffers):
+        if i:
+            print("\n" + "-"*50 + "\n")
+        while not buffer.empty():
+            logger.handle(buffer.get())
+
+    for future in futures:
+        future.result()  # Re-raise configuration errors such as missing environment variables
+
 def main():
     load_dotenv()
     
-    test_instagram_connection()
-    print("\n" + "-"*50 + "\n")
-    test_supabase_connection()
-    print("\n" + "-"*50 + "\n")
-    test_pinecone_connection()
+    run_checks_concurrently([test_instagram_connection, test_supabase_connection, test_pinecone_connection])
 
 if __name__ == "__main__":
     main()
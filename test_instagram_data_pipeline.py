@@ -1,120 +1,322 @@
+import base64
+import importlib
 import unittest
-from unittest.mock import patch, MagicMock
-from instagram_data_pipeline_v2 import InstagramDataPipelineV2
+from contextlib import ExitStack
+import numpy as np
+import orjson
+import re
+import threading
+from unittest.mock import patch, MagicMock, create_autospec
 from datetime import datetime, timezone
+from types import SimpleNamespace
+
+_EPOCH_MIN = datetime.min.replace(tzinfo=timezone.utc)
+_PIPELINE_CLASS = 'instagram_data_pipeline_v2.InstagramDataPipelineV2'
+_CLEAN_TEXT_CASES = (
+    ("Hello, World! 👋 https://example.com", "hello world waving_hand"),
+    ("Visit www.example.com: NOW!!", "visit now"),
+    (None, ""),
+)
+
+
+class _Resp:
+    # Just the parts of requests.Response the pipeline reads
+    __slots__ = ('content', 'headers')
+
+    def __init__(self, content=b'', headers=None):
+        self.content = content
+        self.headers = headers or {}
+
+    def raise_for_status(self):
+        pass
 
 class TestInstagramDataPipelineV2(unittest.TestCase):
 
-    @patch('instagram_data_pipeline_v2.create_client')
-    @patch('instagram_data_pipeline_v2.OpenAI')
+    @classmethod
+    def setUpClass(cls):
+        # Import the pipeline and its SDKs here rather than at module level,
+        # so test discovery doesn't pay for them
+        cls.module = importlib.import_module('instagram_data_pipeline_v2')
+        supabase = importlib.import_module('supabase')
+        openai = importlib.import_module('openai')
+        pinecone = importlib.import_module('pinecone')
+        cls.NotFoundException = importlib.import_module('pinecone.exceptions').NotFoundException
+
+        # Autospec the SDK clients once; tests only reset them between runs
+        cls.mock_supabase = create_autospec(supabase.Client, instance=True)
+        cls.mock_openai = create_autospec(openai.OpenAI, instance=True)
+        cls.mock_openai.embeddings = create_autospec(openai.resources.Embeddings, instance=True)  # cached_property isn't autospecced
+        cls.mock_pinecone = create_autospec(pinecone.Index, instance=True)
+        pinecone_client = create_autospec(pinecone.Pinecone, instance=True)
+        pinecone_client.Index.return_value = cls.mock_pinecone
+
+        # Patch the external clients and build the pipeline once for the whole class
+        cls._stack = ExitStack()
+        cls._stack.enter_context(patch('instagram_data_pipeline_v2.create_client', return_value=cls.mock_supabase))
+        cls._stack.enter_context(patch('instagram_data_pipeline_v2.OpenAI', return_value=cls.mock_openai))
+        cls._stack.enter_context(patch('instagram_data_pipeline_v2.Pinecone', return_value=pinecone_client))
+
+        # Prebuild the Supabase query chains the tests configure
+        query = cls.mock_supabase.table.return_value.select.return_value
+        cls._select_chain = query.eq.return_value.execute
+        cls._cache_lookup_chain = query.in_.return_value.execute
+
+        with patch.object(cls.module.InstagramDataPipelineV2, 'load_last_fetch_time', return_value=_EPOCH_MIN):
+            cls.pipeline = cls.module.InstagramDataPipelineV2()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls._stack.close()
+
+    def setUp(self):
+        self.mock_supabase.reset_mock(return_value=False, side_effect=True)
+        self.mock_openai.reset_mock(return_value=False, side_effect=True)
+        self.mock_pinecone.reset_mock(return_value=False, side_effect=True)
+        self.pipeline.last_fetch_time = _EPOCH_MIN
+        self.pipeline._embedding_cache.clear()
+
     @patch('instagram_data_pipeline_v2.Pinecone')
-    def setUp(self, mock_pinecone, mock_openai, mock_supabase):
-        self.mock_supabase = MagicMock()
-        mock_supabase.return_value = self.mock_supabase
-        self.mock_openai = MagicMock()
-        mock_openai.return_value = self.mock_openai
-        self.mock_pinecone = MagicMock()
-        mock_pinecone.return_value.Index.return_value = self.mock_pinecone
-        
-        with patch.object(InstagramDataPipelineV2, 'load_last_fetch_time', return_value=datetime.min.replace(tzinfo=timezone.utc)):
-            self.pipeline = InstagramDataPipelineV2()
+    def test_init_pinecone_creates_missing_index(self, mock_pinecone):
+        mock_index = MagicMock()
+        mock_pinecone.return_value.Index.side_effect = [self.NotFoundException(status=404, reason='Not Found'), mock_index]
+
+        result = self.pipeline.init_pinecone()
+
+        mock_pinecone.return_value.create_index.assert_called_once()
+        mock_pinecone.return_value.list_indexes.assert_not_called()
+        self.assertIs(result, mock_index)
 
     def test_load_last_fetch_time(self):
-        mock_result = MagicMock()
-        mock_result.data = [{'value': '2023-01-01T00:00:00+00:00'}]
-        self.mock_supabase.table().select().eq().execute.return_value = mock_result
+        self._select_chain.return_value = SimpleNamespace(data=[{'value': '2023-01-01T00:00:00+00:00'}])
 
         result = self.pipeline.load_last_fetch_time()
         self.assertEqual(result, datetime(2023, 1, 1, tzinfo=timezone.utc))
 
-    @patch('instagram_data_pipeline_v2.requests.get')
-    def test_make_paginated_request(self, mock_get):
-        mock_response = MagicMock()
-        mock_response.json.return_value = {
-            'data': [{'id': '1', 'caption': 'Test post'}],
-            'paging': {'next': None}
-        }
-        mock_get.return_value = mock_response
+    def test_make_paginated_request(self):
+        pages = [
+            {'data': [{'id': '1', 'caption': 'Test post'}], 'paging': {'next': 'https://test.com/p2'}},
+            {'data': [{'id': '2', 'caption': 'Second post'}], 'paging': {'next': 'https://test.com/p3'}},
+            {'data': [{'id': '3', 'caption': 'Third post'}], 'paging': {'next': None}}
+        ]
+        mock_responses = [_Resp(orjson.dumps(page)) for page in pages]
+
+        with patch.object(self.pipeline.session, 'get', side_effect=mock_responses) as mock_get:
+            result = self.pipeline._make_paginated_request('https://test.com', {'limit': 1})
+
+        self.assertEqual(len(result), 3)
+        self.assertEqual([item['id'] for item in result], ['1', '2', '3'])
+        self.assertEqual(mock_get.call_count, 3)
+        self.assertEqual(mock_get.call_args_list[1].args, ('https://test.com/p2',))
+        self.assertEqual(mock_get.call_args_list[1].kwargs, {'params': {}})
+
+    def test_make_paginated_request_stops_early(self):
+        mock_response = _Resp(orjson.dumps({
+            'data': [{'id': '1', 'timestamp': '2023-01-01T00:00:00+0000'}],
+            'paging': {'next': 'https://test.com/page2'}
+        }))
+
+        with patch.object(self.pipeline.session, 'get', return_value=mock_response) as mock_get:
+            result = self.pipeline._make_paginated_request('https://test.com', {}, stop_predicate=lambda page: True)
 
-        result = self.pipeline._make_paginated_request('https://test.com', {})
         self.assertEqual(len(result), 1)
-        self.assertEqual(result[0]['id'], '1')
+        mock_get.assert_called_once()
 
-    def test_clean_text(self):
-        text = "Hello, World! 👋 https://example.com"
-        cleaned_text = self.pipeline.clean_text(text)
-        self.assertEqual(cleaned_text, "hello world waving_hand")
-
-    @patch.object(InstagramDataPipelineV2, 'fetch_all_posts')
-    @patch.object(InstagramDataPipelineV2, 'fetch_comments')
-    @patch.object(InstagramDataPipelineV2, 'fetch_reply')
-    @patch.object(InstagramDataPipelineV2, 'generate_embedding')
-    def test_process_and_upload_data(self, mock_generate_embedding, mock_fetch_reply, mock_fetch_comments, mock_fetch_all_posts):
-        mock_fetch_all_posts.return_value = [
-            {'id': '1', 'caption': 'Test post', 'timestamp': '2023-01-01T00:00:00+0000'}
+        # The prefetching iterator must not request pages past the stop condition either
+        with patch.object(self.pipeline.session, 'get', return_value=mock_response) as mock_get:
+            pages = list(self.pipeline._iter_paginated_request('https://test.com', {}, stop_predicate=lambda page: True))
+
+        self.assertEqual(len(pages), 1)
+        mock_get.assert_called_once()
+
+    @patch('instagram_data_pipeline_v2.time.sleep')
+    def test_throttle_only_near_usage_limit(self, mock_sleep):
+        self.pipeline._throttle(_Resp(headers={'X-App-Usage': '{"call_count": 20, "total_time": 10, "total_cputime": 5}'}))
+        mock_sleep.assert_not_called()
+
+        self.pipeline._throttle(_Resp(headers={'X-App-Usage': '{"call_count": 90, "total_time": 10, "total_cputime": 5}'}))
+        mock_sleep.assert_called_once_with(6.0)
+
+        # In the prefetch worker the wait uses the stop event instead, so a stopped consumer cuts it short
+        mock_sleep.reset_mock()
+        stop = MagicMock(spec=threading.Event)
+        self.pipeline._throttle(_Resp(headers={'X-App-Usage': '{"call_count": 90, "total_time": 10, "total_cputime": 5}'}), stop)
+        stop.wait.assert_called_once_with(6.0)
+        mock_sleep.assert_not_called()
+
+    def test_iter_post_pages_logs_cut_off_posts(self):
+        self.pipeline.last_fetch_time = datetime(2023, 1, 1, tzinfo=timezone.utc)
+        page = [
+            {'id': '2', 'timestamp': '2023-01-02T00:00:00+0000'},
+            {'id': '1', 'timestamp': '2022-12-31T00:00:00+0000'}
         ]
+
+        with patch.object(self.pipeline, '_iter_media_pages', return_value=iter([page])):
+            with self.assertLogs('instagram_data_pipeline_v2', level='INFO') as logs:
+                pages = list(self.pipeline.iter_post_pages())
+
+        self.assertEqual([[post['id'] for post in page] for page in pages], [['2']])
+        self.assertIn('Skipped 1 posts older than', logs.output[-1])
+
+    def test_fetch_comments_follows_reply_paging(self):
+        comments = [{
+            'id': 'c1', 'text': 'Test comment', 'timestamp': '2023-01-01T00:00:00+0000',
+            'replies': {
+                'data': [{'id': 'r1', 'text': 'Test reply', 'timestamp': '2023-01-01T00:00:00+0000'}],
+                'paging': {'next': 'https://test.com/c1/replies?after=r1'}
+            }
+        }]
+        more_replies = [{'id': 'r2', 'text': 'Another reply', 'timestamp': '2023-01-01T00:00:00+0000'}]
+
+        with patch.object(self.pipeline, '_make_paginated_request', side_effect=[comments, more_replies]) as mock_request:
+            result = self.pipeline.fetch_comments('1')
+
+        mock_request.assert_called_with('https://test.com/c1/replies?after=r1', {})
+        self.assertEqual([reply['id'] for reply in result[0]['replies']['data']], ['r1', 'r2'])
+
+    def test_clean_text(self):
+        for text, expected in _CLEAN_TEXT_CASES:
+            with self.subTest(text=text):
+                self.assertEqual(self.pipeline.clean_text(text), expected)
+
+    def test_clean_text_uses_precompiled_patterns(self):
+        self.assertIsInstance(self.module._URL_RE, re.Pattern)
+        self.assertIsInstance(self.module._NON_ALPHA_RE, re.Pattern)
+        # Any module-level re call (re.sub, re.compile, ...) would compile or look up a pattern per call
+        with patch.object(self.module, 're', wraps=re) as mock_re:
+            for text, _ in _CLEAN_TEXT_CASES:
+                self.pipeline.clean_text(text)
+        self.assertEqual(mock_re.mock_calls, [])
+
+    @patch(f'{_PIPELINE_CLASS}.iter_post_pages')
+    @patch(f'{_PIPELINE_CLASS}.fetch_comments')
+    @patch(f'{_PIPELINE_CLASS}.generate_embeddings')
+    def test_process_and_upload_data(self, mock_generate_embeddings, mock_fetch_comments, mock_iter_post_pages):
+        mock_iter_post_pages.return_value = iter([
+            [{'id': '1', 'caption': 'Test post', 'timestamp': '2023-01-01T00:00:00+0000'}]
+        ])
         mock_fetch_comments.return_value = [
-            {'id': 'c1', 'text': 'Test comment', 'timestamp': '2023-01-01T00:00:00+0000', 'replies': {'data': [{'id': 'r1'}]}}
+            {'id': 'c1', 'text': 'Test comment', 'timestamp': '2023-01-01T00:00:00+0000', 'replies': {'data': [
+                {'id': 'r1', 'text': 'Test reply', 'timestamp': '2023-01-01T00:00:00+0000'}
+            ]}}
         ]
-        mock_fetch_reply.return_value = {
-            'id': 'r1', 'text': 'Test reply', 'timestamp': '2023-01-01T00:00:00+0000'
-        }
-        mock_generate_embedding.return_value = [0.1, 0.2, 0.3]
-
-        self.pipeline.process_and_upload_data()
-
-        # Check that upsert was called for posts, comments, and replies
-        self.mock_supabase.table().upsert.assert_any_call(
-            {'id': '1', 'caption': 'Test post', 'timestamp': '2023-01-01T00:00:00+0000'},
-            on_conflict='id'
-        )
-        self.mock_supabase.table().upsert.assert_any_call(
-            {'id': 'c1', 'post_id': '1', 'text': 'Test comment', 'timestamp': '2023-01-01T00:00:00+0000', 'username': 'unknown_user', 'replied': False},
-            on_conflict='id'
-        )
-        self.mock_supabase.table().upsert.assert_any_call(
-            {'id': 'r1', 'post_id': '1', 'parent_comment_id': 'c1', 'text': 'Test reply', 'timestamp': '2023-01-01T00:00:00+0000', 'username': 'unknown_user', 'replied': False},
-            on_conflict='id'
-        )
-
-        # Check that Pinecone upsert was called with the correct vectors
-        expected_vectors = [
-            {
-                'id': '1',
-                'values': [0.1, 0.2, 0.3],
-                'metadata': {
-                    'type': 'post',
-                    'timestamp': '2023-01-01T00:00:00+0000',
-                    'likes': 0,
-                    'comments': 0,
-                    'text': 'test post'
-                }
-            },
-            {
-                'id': 'c1',
-                'values': [0.1, 0.2, 0.3],
-                'metadata': {
-                    'type': 'comment',
-                    'timestamp': '2023-01-01T00:00:00+0000',
-                    'post_id': '1',
-                    'username': 'unknown_user',
-                    'text': 'test comment'
-                }
+        mock_generate_embeddings.side_effect = lambda texts: np.tile(np.array([0.5, 0.25, 0.125], dtype=np.float32), (len(texts), 1))
+
+        with patch.object(self.pipeline, 'upsert_rows', wraps=self.pipeline.upsert_rows) as mock_upsert_rows:
+            self.pipeline.process_and_upload_data()
+
+        # All three items should be embedded in a single batched request
+        mock_generate_embeddings.assert_called_once_with(['test post', 'test comment', 'test reply'])
+
+        # Check that posts, then comments (including replies), were upserted to their own tables, diffing all rows at once
+        upsert_calls = self.mock_supabase.table.return_value.upsert.call_args_list
+        self.assertTrue(all(c.kwargs == {'on_conflict': 'id'} for c in upsert_calls))
+        row_calls = [c.args for c in mock_upsert_rows.call_args_list if c.args[0] != 'embedding_cache']
+        self.assertEqual([table for table, _ in row_calls], ['posts', 'comments'])
+        upserted = {table: {row['id']: row for row in rows} for table, rows in row_calls}
+        self.assertEqual(upserted, {
+            'posts': {
+                '1': {'id': '1', 'caption': 'Test post', 'timestamp': '2023-01-01T00:00:00+0000'}
             },
-            {
-                'id': 'r1',
-                'values': [0.1, 0.2, 0.3],
-                'metadata': {
-                    'type': 'reply',
-                    'timestamp': '2023-01-01T00:00:00+0000',
-                    'post_id': '1',
-                    'parent_comment_id': 'c1',
-                    'username': 'unknown_user',
-                    'text': 'test reply'
-                }
+            'comments': {
+                'c1': {'id': 'c1', 'post_id': '1', 'text': 'Test comment', 'timestamp': '2023-01-01T00:00:00+0000', 'username': 'unknown_user', 'replied': False},
+                'r1': {'id': 'r1', 'post_id': '1', 'parent_comment_id': 'c1', 'text': 'Test reply', 'timestamp': '2023-01-01T00:00:00+0000', 'username': 'unknown_user', 'replied': False}
             }
+        })
+
+        # Check that Pinecone received one batched upsert with each item in order
+        self.mock_pinecone.upsert.assert_called_once()
+        vectors = self.mock_pinecone.upsert.call_args.kwargs['vectors']
+        self.assertEqual(len(vectors), 3)
+        self.assertEqual([(v['id'], v['metadata']['type']) for v in vectors], [('1', 'post'), ('c1', 'comment'), ('r1', 'reply')])
+        self.assertEqual(vectors[0]['values'], [0.5, 0.25, 0.125])
+        self.assertEqual(vectors[2]['metadata']['parent_comment_id'], 'c1')
+
+    def test_generate_embeddings(self):
+        mock_response = MagicMock()
+        mock_response.data = [
+            MagicMock(embedding=base64.b64encode(np.array([0.5, 0.25], dtype=np.float32).tobytes()).decode()),
+            MagicMock(embedding=base64.b64encode(np.array([0.125, 1.0], dtype=np.float32).tobytes()).decode())
+        ]
+        self.mock_openai.embeddings.create.return_value = mock_response
+
+        result = self.pipeline.generate_embeddings(['first', 'second'])
+
+        self.assertEqual(result.dtype, np.float32)
+        self.assertEqual(result.tolist(), [[0.5, 0.25], [0.125, 1.0]])
+
+    @patch(f'{_PIPELINE_CLASS}.generate_embeddings')
+    def test_embed_pending_deduplicates_texts(self, mock_generate_embeddings):
+        mock_generate_embeddings.side_effect = lambda texts: np.ones((len(texts), 3), dtype=np.float32)
+        pending = [
+            ('c1', {'type': 'comment', 'text': 'nice'}),
+            ('c2', {'type': 'comment', 'text': 'nice'})
+        ]
+
+        vectors = list(self.pipeline.embed_pending(pending))
+
+        mock_generate_embeddings.assert_called_once_with(['nice'])
+        self.assertEqual([v['id'] for v in vectors], ['c1', 'c2'])
+
+    @patch(f'{_PIPELINE_CLASS}.generate_embeddings')
+    def test_embed_pending_skips_empty_texts(self, mock_generate_embeddings):
+        mock_generate_embeddings.side_effect = lambda texts: np.ones((len(texts), 3), dtype=np.float32)
+        pending = [
+            ('1', {'type': 'post', 'text': ''}),
+            ('c1', {'type': 'comment', 'text': 'nice'})
+        ]
+
+        vectors = list(self.pipeline.embed_pending(pending))
+
+        mock_generate_embeddings.assert_called_once_with(['nice'])
+        self.assertEqual([v['id'] for v in vectors], ['c1'])
+
+    @patch(f'{_PIPELINE_CLASS}.generate_embedding')
+    @patch(f'{_PIPELINE_CLASS}.generate_embeddings')
+    def test_embed_pending_falls_back_to_single_requests(self, mock_generate_embeddings, mock_generate_embedding):
+        mock_generate_embeddings.side_effect = Exception("Batch failed")
+        mock_generate_embedding.side_effect = [np.array([0.5, 0.25, 0.125], dtype=np.float32), Exception("Invalid input")]
+        pending = [
+            ('1', {'type': 'post', 'text': 'test post'}),
+            ('c1', {'type': 'comment', 'text': 'bad input'})
         ]
-        self.mock_pinecone.upsert.assert_called_with(vectors=expected_vectors)
+
+        vectors = list(self.pipeline.embed_pending(pending))
+
+        self.assertEqual(len(vectors), 1)
+        self.assertEqual(vectors[0]['id'], '1')
+        self.assertEqual(vectors[0]['values'].tolist(), [0.5, 0.25, 0.125])
+        self.assertEqual(mock_generate_embedding.call_count, 2)
+
+    @patch(f'{_PIPELINE_CLASS}.generate_embeddings')
+    def test_embed_texts_reuses_cached_embeddings(self, mock_generate_embeddings):
+        mock_generate_embeddings.side_effect = lambda texts: np.ones((len(texts), 3), dtype=np.float32)
+        self._cache_lookup_chain.return_value = MagicMock(data=[])
+
+        list(self.pipeline.embed_texts(['nice']))
+        cached = list(self.pipeline.embed_texts(['nice']))
+
+        mock_generate_embeddings.assert_called_once_with(['nice'])
+        self.assertEqual(cached[0]['nice'].tolist(), [1.0, 1.0, 1.0])
+
+    def test_save_cached_embeddings_uses_small_batches(self):
+        embeddings = {str(i): np.ones(3, dtype=np.float32) for i in range(120)}
+
+        self.pipeline.save_cached_embeddings(embeddings)
+
+        self.mock_supabase.table.assert_called_with('embedding_cache')
+        upsert_calls = self.mock_supabase.table.return_value.upsert.call_args_list
+        self.assertEqual([len(c.args[0]) for c in upsert_calls], [50, 50, 20])
+
+    @patch(_PIPELINE_CLASS)
+    def test_main_reuses_pipeline(self, mock_pipeline_class):
+        with patch.object(self.module, '_PIPELINE', None):
+            self.module.main(None, None)
+            result = self.module.main(None, None)
+
+        mock_pipeline_class.assert_called_once()
+        mock_pipeline_class.return_value.load_last_fetch_time.assert_called_once()
+        self.assertEqual(mock_pipeline_class.return_value.run.call_count, 2)
+        self.assertEqual(result, ("Data pipeline completed successfully", 200))
 
 if __name__ == '__main__':
     unittest.main()